@@ -1,25 +1,88 @@
+from copy import deepcopy
 from time import time
+from types import MappingProxyType
 
-import responses
-from freezegun import freeze_time
+from django.utils.functional import cached_property
 
 from sentry.integrations.vsts.integration import VstsIntegration
 from sentry.integrations.vsts.notify_action import AzureDevopsCreateTicketAction
 from sentry.models import ExternalIssue, GroupLink, Identity, IdentityProvider, Integration, Rule
 from sentry.testutils.cases import RuleTestCase
+from sentry.testutils.factories import Factories
+from sentry.testutils.helpers.datetime import before_now, iso_format
 from sentry.types.rules import RuleFuture
 from sentry.utils import json
 
-from .test_issues import VstsIssueBase
-from .testutils import GET_PROJECTS_RESPONSE, WORK_ITEM_RESPONSE
+from .testutils import WORK_ITEM_RESPONSE, VstsMockTransport, build_json_response
+
+# Rule actions mutate their data in place, so copy these on every use.
+_BASE_RULE_DATA = {
+    "title": "Hello",
+    "description": "Fix this.",
+    "project": "0987654321",
+    "work_item_type": "Microsoft.VSTS.WorkItemTypes.Task",
+}
+
+_DYNAMIC_FORM_FIELDS = {
+    "project": {
+        "name": "project",
+        "required": True,
+        "type": "choice",
+        "choices": [("ac7c05bb-7f8e-4880-85a6-e08f37fd4a10", "Fabrikam-Fiber-Git")],
+        "defaultValue": "ac7c05bb-7f8e-4880-85a6-e08f37fd4a10",
+        "label": "Project",
+        "placeholder": "ac7c05bb-7f8e-4880-85a6-e08f37fd4a10",
+        "updatesForm": True,
+    },
+    "work_item_type": {
+        "name": "work_item_type",
+        "required": True,
+        "type": "choice",
+        "choices": [
+            ("Microsoft.VSTS.WorkItemTypes.Issue", "Issue"),
+            ("Microsoft.VSTS.WorkItemTypes.Epic", "Epic"),
+            ("Microsoft.VSTS.WorkItemTypes.TestCase", "Test Case"),
+            ("Microsoft.VSTS.WorkItemTypes.SharedStep", "Shared Steps"),
+            ("Microsoft.VSTS.WorkItemTypes.SharedParameter", "Shared Parameter"),
+            ("Microsoft.VSTS.WorkItemTypes.CodeReviewRequest", "Code Review Request"),
+            ("Microsoft.VSTS.WorkItemTypes.CodeReviewResponse", "Code Review Response"),
+            ("Microsoft.VSTS.WorkItemTypes.FeedbackRequest", "Feedback Request"),
+            ("Microsoft.VSTS.WorkItemTypes.FeedbackResponse", "Feedback Response"),
+            ("Microsoft.VSTS.WorkItemTypes.TestPlan", "Test Plan"),
+            ("Microsoft.VSTS.WorkItemTypes.TestSuite", "Test Suite"),
+            ("Microsoft.VSTS.WorkItemTypes.Task", "Task"),
+        ],
+        "defaultValue": "Microsoft.VSTS.WorkItemTypes.Issue",
+        "label": "Work Item Type",
+        "placeholder": "Bug",
+    },
+}
+
+_VSTS_API_ROUTES = MappingProxyType(
+    {
+        (
+            "PATCH",
+            "https://fabrikam-fiber-inc.visualstudio.com/0987654321/_apis/wit/workitems/$Microsoft.VSTS.WorkItemTypes.Task",
+        ): build_json_response(WORK_ITEM_RESPONSE),
+    }
+)
 
 
-@freeze_time()
-class AzureDevopsCreateTicketActionTest(RuleTestCase, VstsIssueBase):
+class AzureDevopsCreateTicketActionTest(RuleTestCase):
     rule_cls = AzureDevopsCreateTicketAction
 
-    def setUp(self):
-        model = Integration.objects.create(
+    @classmethod
+    def setUpTestData(cls):
+        # Built once per class and rolled back at class teardown, instead of
+        # re-inserting the same integration/identity rows for every test.
+        # user, organization, team, project and event replace the Fixtures
+        # properties of the same name for this class, so all of them must be
+        # assigned here or the lazy fixture would create a conflicting copy.
+        # Django 2.2 only rolls back the rows; the Python objects below are
+        # shared by every test in the class and must not be mutated.
+        cls.user = Factories.create_user("admin@localhost", is_superuser=True)
+        cls.organization = Factories.create_organization(name="baz", slug="baz", owner=cls.user)
+        cls.integration_model = Integration.objects.create(
             provider="vsts",
             external_id="vsts_external_id",
             name="fabrikam-fiber-inc",
@@ -28,63 +91,70 @@ class AzureDevopsCreateTicketActionTest(RuleTestCase, VstsIssueBase):
                 "default_project": "0987654321",
             },
         )
+        idp, _ = IdentityProvider.objects.get_or_create(type="vsts", defaults={"config": {}})
         identity = Identity.objects.create(
-            idp=IdentityProvider.objects.create(type="vsts", config={}),
-            user=self.user,
+            idp=idp,
+            user=cls.user,
             external_id="vsts",
             data={"access_token": "123456789", "expires": time() + 1234567},
         )
-        model.add_organization(self.organization, self.user, identity.id)
-        self.integration = VstsIntegration(model, self.organization.id)
+        cls.integration_model.add_organization(cls.organization, cls.user, identity.id)
 
-    @responses.activate
-    def test_create_issue(self):
-        self.mock_categories("ac7c05bb-7f8e-4880-85a6-e08f37fd4a10")
-        event = self.get_event()
-        azuredevops_rule = self.get_rule(
-            data={
-                "title": "Hello",
-                "description": "Fix this.",
-                "project": "0987654321",
-                "work_item_type": "Microsoft.VSTS.WorkItemTypes.Task",
-                "integration": self.integration.model.id,
-            }
+        # Storing an event is the most expensive part of setup; the create and
+        # doesn't-create tests share it along with the rule that fires it.
+        cls.team = Factories.create_team(
+            organization=cls.organization, name="foo", slug="foo", members=[cls.user]
         )
-        debug_data_capture = azuredevops_rule.data  # noqa: F841
-        debug_rule_obj = Rule.objects.create(project=self.project, label="test rule")
-        azuredevops_rule.rule = debug_rule_obj
-        responses.reset()
-        responses.add(
-            responses.PATCH,
-            "https://fabrikam-fiber-inc.visualstudio.com/0987654321/_apis/wit/workitems/$Microsoft.VSTS.WorkItemTypes.Task",
-            body=WORK_ITEM_RESPONSE,
-            content_type="application/json",
+        cls.project = Factories.create_project(
+            organization=cls.organization,
+            teams=[cls.team],
+            name="Bar",
+            slug="bar",
+            fire_project_created=True,
         )
+        cls.event = Factories.store_event(
+            data={
+                "event_id": "a" * 32,
+                "message": "\u3053\u3093\u306b\u3061\u306f",
+                "timestamp": iso_format(before_now(seconds=1)),
+            },
+            project_id=cls.project.id,
+        )
+        cls.rule = Rule.objects.create(project=cls.project, label="test rule")
 
-        debug_response_urls = [mock.url for mock in responses._default_mock._matches]  # noqa: F841
-
-        debug_state = self.get_state()
-        after_res = azuredevops_rule.after(event=event, state=debug_state)
-        results = list(after_res)
-        assert len(results) == 1
-
-        # Trigger rule callback
-        debug_kwargs = results[0].kwargs
-        rule_future = RuleFuture(rule=azuredevops_rule, kwargs=debug_kwargs)
-        results[0].callback(event, futures=[rule_future])
-        data = json.loads(responses.calls[0].response.text)
-
-        assert data["fields"]["System.Title"] == "Hello"
-        assert data["fields"]["System.Description"] == "Fix this."
+    @cached_property
+    def integration(self):
+        return VstsIntegration(self.integration_model, self.organization.id)
 
-        external_issue = ExternalIssue.objects.get(key="309")
-        assert external_issue
+    def test_create_issue(self):
+        event = self.get_event()
+        azuredevops_rule = self.get_rule(
+            data={**_BASE_RULE_DATA, "integration": self.integration.model.id}
+        )
+        azuredevops_rule.rule = self.rule
+
+        with VstsMockTransport(_VSTS_API_ROUTES) as transport:
+            results = iter(azuredevops_rule.after(event=event, state=self.get_state()))
+            result = next(results, None)
+            assert result is not None
+            assert next(results, None) is None
+
+            # Trigger rule callback
+            rule_future = RuleFuture(rule=azuredevops_rule, kwargs=result.kwargs)
+            result.callback(event, futures=[rule_future])
+            assert len(transport.calls) == 1
+            payload = json.loads(transport.calls[0].body)
+            assert {"op": "add", "path": "/fields/System.Title", "value": event.title} in payload
+            description = next(
+                op["value"] for op in payload if op["path"] == "/fields/System.Description"
+            )
+            assert "This work item was automatically created by Sentry via" in description
+
+        assert ExternalIssue.objects.filter(key="309").exists()
 
-    @responses.activate
     def test_doesnt_create_issue(self):
         """Don't create an issue if one already exists on the event"""
 
-        self.mock_categories("ac7c05bb-7f8e-4880-85a6-e08f37fd4a10")
         event = self.get_event()
         external_issue = ExternalIssue.objects.create(
             organization_id=self.organization.id,
@@ -101,27 +171,16 @@ class AzureDevopsCreateTicketActionTest(RuleTestCase, VstsIssueBase):
             relationship=GroupLink.Relationship.references,
             data={"provider": self.integration.model.provider},
         )
-        responses.add(
-            responses.GET,
-            "https://fabrikam-fiber-inc.visualstudio.com/_apis/projects?stateFilter=WellFormed&%24skip=0&%24top=100",
-            body=GET_PROJECTS_RESPONSE,
-            content_type="application/json",
-        )
         azuredevops_rule = self.get_rule(
-            data={
-                "title": "Hello",
-                "description": "Fix this.",
-                "project": "0987654321",
-                "work_item_type": "Microsoft.VSTS.WorkItemTypes.Task",
-                "integration": self.integration.model.id,
-            }
+            data={**_BASE_RULE_DATA, "integration": self.integration.model.id}
         )
-        azuredevops_rule.rule = Rule.objects.create(project=self.project, label="test rule")
+        azuredevops_rule.rule = self.rule
 
-        results = list(azuredevops_rule.after(event=event, state=self.get_state()))
-        assert len(results) == 1
-        results[0].callback(event, futures=[])
-        assert len(responses.calls) == 0
+        with VstsMockTransport(_VSTS_API_ROUTES) as transport:
+            results = list(azuredevops_rule.after(event=event, state=self.get_state()))
+            assert len(results) == 1
+            results[0].callback(event, futures=[])
+            assert len(transport.calls) == 0
 
     def test_render_label(self):
         azuredevops_rule = self.get_rule(
@@ -129,46 +188,7 @@ class AzureDevopsCreateTicketActionTest(RuleTestCase, VstsIssueBase):
                 "integration": self.integration.model.id,
                 "work_item_type": "Microsoft.VSTS.WorkItemTypes.Task",
                 "project": "0987654321",
-                "dynamic_form_fields": {
-                    "project": {
-                        "name": "project",
-                        "required": True,
-                        "type": "choice",
-                        "choices": [("ac7c05bb-7f8e-4880-85a6-e08f37fd4a10", "Fabrikam-Fiber-Git")],
-                        "defaultValue": "ac7c05bb-7f8e-4880-85a6-e08f37fd4a10",
-                        "label": "Project",
-                        "placeholder": "ac7c05bb-7f8e-4880-85a6-e08f37fd4a10",
-                        "updatesForm": True,
-                    },
-                    "work_item_type": {
-                        "name": "work_item_type",
-                        "required": True,
-                        "type": "choice",
-                        "choices": [
-                            ("Microsoft.VSTS.WorkItemTypes.Issue", "Issue"),
-                            ("Microsoft.VSTS.WorkItemTypes.Epic", "Epic"),
-                            ("Microsoft.VSTS.WorkItemTypes.TestCase", "Test Case"),
-                            ("Microsoft.VSTS.WorkItemTypes.SharedStep", "Shared Steps"),
-                            ("Microsoft.VSTS.WorkItemTypes.SharedParameter", "Shared Parameter"),
-                            (
-                                "Microsoft.VSTS.WorkItemTypes.CodeReviewRequest",
-                                "Code Review Request",
-                            ),
-                            (
-                                "Microsoft.VSTS.WorkItemTypes.CodeReviewResponse",
-                                "Code Review Response",
-                            ),
-                            ("Microsoft.VSTS.WorkItemTypes.FeedbackRequest", "Feedback Request"),
-                            ("Microsoft.VSTS.WorkItemTypes.FeedbackResponse", "Feedback Response"),
-                            ("Microsoft.VSTS.WorkItemTypes.TestPlan", "Test Plan"),
-                            ("Microsoft.VSTS.WorkItemTypes.TestSuite", "Test Suite"),
-                            ("Microsoft.VSTS.WorkItemTypes.Task", "Task"),
-                        ],
-                        "defaultValue": "Microsoft.VSTS.WorkItemTypes.Issue",
-                        "label": "Work Item Type",
-                        "placeholder": "Bug",
-                    },
-                },
+                "dynamic_form_fields": deepcopy(_DYNAMIC_FORM_FIELDS),
             }
         )
 
@@ -179,7 +199,9 @@ class AzureDevopsCreateTicketActionTest(RuleTestCase, VstsIssueBase):
 
     def test_render_label_without_integration(self):
         deleted_id = self.integration.model.id
-        self.integration.model.delete()
+        # Model.delete() would clear the pk on the shared class-level instance,
+        # so delete through a queryset instead.
+        Integration.objects.filter(id=deleted_id).delete()
 
         rule = self.get_rule(data={"integration": deleted_id})
 
@@ -1,6 +1,11 @@
+from copy import copy
+from typing import Any, List, Mapping, Tuple
+from unittest.mock import patch
 from urllib.parse import parse_qs, urlencode, urlparse
 
+import requests
 import responses
+from requests.adapters import HTTPAdapter
 
 from sentry.integrations.vsts import VstsIntegrationProvider
 from sentry.testutils import IntegrationTestCase
@@ -811,3 +816,46 @@ GET_PROJECTS_RESPONSE = """{
         "visibility": "private"
     }]
 }"""
+
+
+def build_json_response(body: str, status: int = 200) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response.headers["Content-Type"] = "application/json"
+    response.encoding = "utf-8"
+    response._content = body.encode("utf-8")
+    return response
+
+
+class VstsMockTransport:
+    """
+    Answers every outgoing ``requests`` call from a dict of prebuilt responses
+    keyed on ``(method, url without query string)``, by patching
+    ``HTTPAdapter.send`` while active. Requests to any other URL raise
+    ``ConnectionError``. Sent requests are recorded on ``calls``.
+    """
+
+    def __init__(self, routes: Mapping[Tuple[str, str], requests.Response]) -> None:
+        self.routes = routes
+        self.calls: List[requests.PreparedRequest] = []
+        self._patcher = patch.object(HTTPAdapter, "send", autospec=True, side_effect=self.send)
+
+    def __enter__(self) -> "VstsMockTransport":
+        self._patcher.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._patcher.stop()
+
+    def send(
+        self, adapter: HTTPAdapter, request: requests.PreparedRequest, **kwargs: Any
+    ) -> requests.Response:
+        self.calls.append(request)
+        key = (request.method, request.url.split("?")[0])
+        try:
+            response = copy(self.routes[key])
+        except KeyError:
+            raise requests.ConnectionError(f"No mocked VSTS route for {key}", request=request)
+        response.request = request
+        response.url = request.url
+        return response